@@ -2,6 +2,22 @@
 """latex2svg
 
 Based on the [work](https://github.com/Moonbase59/latex2svg) of Matthias C. Hormann.
+
+Templates (`params["template"]`) are Python format strings: `{preamble}`,
+`{fontsize}` and `{code}` are substituted, and the template's own LaTeX
+braces must be doubled (`\\begin{{document}}`). Snippets are inserted as
+they are, their braces are not doubled.
+
+Each snippet is wrapped in a `mathenv` environment and typeset on its own
+page, so a custom template must use the `standalone` class with the
+`multi=mathenv` option, and define and declare the environment in its
+preamble, as `default_template` does. The `preview` option is needed too:
+dvisvgm only reports the depth of each formula from preview data, without
+it every baseline offset (`valign`) is 0.
+
+    \\documentclass[preview,multi=mathenv,varwidth]{{standalone}}
+    \\newenvironment{{mathenv}}{{}}{{}}
+    \\standaloneenv{{mathenv}}
 """
 
 VERSION = "0.0.8"
@@ -11,19 +27,20 @@ __email__ = ""
 __license__ = "No License / Public Domain"
 __copyright__ = "Contributions (c) 2024, vlarroque"
 
-import os, sys, subprocess, shlex, re, argparse, random, string
-from tempfile import TemporaryDirectory
+import os, sys, subprocess, re, base64, hashlib, json, atexit, shutil, functools, threading
+from tempfile import TemporaryDirectory, mkstemp, mkdtemp
+from pathlib import Path
 
 default_template = r"""
-\documentclass[preview]{standalone}
-\usepackage{amsmath}
-\usepackage{amsfonts}
-{{ preamble }}
-\begin{document}
-\begin{preview}
-{{ code }}
-\end{preview}
-\end{document}
+\documentclass[preview,multi=mathenv,varwidth]{{standalone}}
+\usepackage{{amsmath}}
+\usepackage{{amsfonts}}
+\newenvironment{{mathenv}}{{}}{{}}
+\standaloneenv{{mathenv}}
+{preamble}
+\begin{{document}}
+{code}
+\end{{document}}
 """
 
 default_preamble = r"""
@@ -32,28 +49,288 @@ default_preamble = r"""
 \usepackage{amsmath}
 """
 
-latex_cmd = "pdflatex -interaction nonstopmode -halt-on-error"
-dvisvgm_cmd = "dvisvgm --pdf --no-fonts --exact-bbox"
-scour_cmd = 'scour --shorten-ids --shorten-ids-prefix="{{ prefix }}" ' "--no-line-breaks --remove-metadata --enable-comment-stripping " "--strip-xml-prolog -i {{ infile }} -o {{ outfile }}"
+# Commands are argv lists, input files and per-call options are appended to them
+latex_cmd = ["latex", "-interaction", "nonstopmode", "-halt-on-error"]
+pdflatex_cmd = ["pdflatex", "-interaction", "nonstopmode", "-halt-on-error"]
+dvisvgm_cmd = ["dvisvgm", "--no-fonts", "--exact-bbox"]
+scour_cmd = [
+    "scour",
+    "--shorten-ids",
+    "--shorten-ids-prefix={{ prefix }}",
+    "--no-line-breaks",
+    "--remove-metadata",
+    "--enable-comment-stripping",
+    "--strip-xml-prolog",
+    "-i",
+    "{{ infile }}",
+    "-o",
+    "{{ outfile }}",
+]
 
 default_params = {
     "fontsize": 12,  # TeX pt
     "template": default_template,
     "preamble": default_preamble,
+    # "latex" converts DVI natively, "pdflatex" goes through dvisvgm --pdf
+    # (needs muPDF or Ghostscript) for packages that only work with PDF output
+    "engine": "latex",
     "latex_cmd": latex_cmd,
+    "pdflatex_cmd": pdflatex_cmd,
     "dvisvgm_cmd": dvisvgm_cmd,
     "scale": 1.0,  # default extra scaling (done by dvisvgm)
     "scour_cmd": scour_cmd,
-    "optimizer": "scour",
+    "optimizer": "internal",  # or "scour" to run the external scour_cmd
     "libgs": None,
+    "cache_dir": os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "latex2svg"),
+    "no_cache": False,  # always run LaTeX, neither reading nor writing the cache
+    # load each distinct preamble once per session, see PreambleFormats; this costs
+    # an extra LaTeX run per preamble and only pays off in long-running processes like ui()
+    "preload_preamble": False,
+    "safe_mode": False,  # rewrite the SVG with lxml instead of regexes
+    "tmp_dir": None,  # where temporary files go, defaults to /dev/shm when writable
 }
 
+# LaTeX and dvisvgm write a dozen small files per run, keep them in memory when possible
+_tmp_root = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+
+_CODE_SENTINEL = "\0CODE\0"
+
+# Results are also memoized in-process, by cache key, in least recently used order
+_memo = {}
+_memo_size = 256
+_memo_lock = threading.Lock()
+
+# Version of the rendered output, part of the cache key: bump it whenever a
+# change to the code (template, SVG rewriting, minifier...) changes the SVGs
+_cache_version = "1"
+
+# Parameters that change the rendered SVG, and thus the cache key
+_cache_params = (
+    "template",
+    "preamble",
+    "fontsize",
+    "scale",
+    "engine",
+    "latex_cmd",
+    "pdflatex_cmd",
+    "dvisvgm_cmd",
+    "optimizer",
+    "scour_cmd",
+    "safe_mode",
+)
+
+# dvisvgm output is matched as bytes, without decoding it
+_MEASURES_RE = re.compile(rb"processing page (\d+)|\b([0-9.]+)pt x ([0-9.]+)pt|\bdepth=([0-9.e-]+)pt|output written to (\S+)")
+
+# Pre-flight check of the LaTeX code, see _trivial_error
+_VERB_RE = re.compile(r"\\verb\*?([^\sa-zA-Z*]).*?\1")
+_ESCAPED_RE = re.compile(r"\\[\\${}%]")
+_COMMENT_RE = re.compile(r"%.*")
+
+# SVG rewriting is done with regexes on the markup, lxml is only used in safe mode
+_SVG_OPEN_RE = re.compile(rb"<svg\b[^>]*>")
+_SIZE_ATTR_RE = re.compile(rb"""\s(?:width|height|style)=(['"]).*?\1""")
+_STRIP_RE = re.compile(r"<\?xml.*?\?>|<!--.*?-->|<metadata\b[^>]*/>|<metadata\b.*?</metadata>", re.DOTALL)
+_ID_RE = re.compile(r"""\bid=['"]([^'"]+)""")
+_ID_REF_RE = re.compile(r"""(\bid=['"]|url\(#|href=['"]#)([^'")]+)""")
+_BETWEEN_TAGS_RE = re.compile(r">\s+<")
+
+# Caution: TeX & dvisvgm work with TeX pt (1/72.27"), but we need DTP pt (1/72")
+# so we need a scaling factor for correct output sizes
+# dvisvgm will produce a viewBox in DTP pt but SHOW TeX pt in its output.
+scaling = 1.00375  # (1/72)/(1/72.27)
+
+
+# Parse dvisvgm output for size and alignment
+def get_measures(output, fontsize):
+    """Return the width, height, depth (in em) and SVG file of every page reported by dvisvgm.
+
+    dvisvgm prints the measures and output file of each page after a
+    "processing page N" line, they are all collected in a single pass over its
+    output. The file is None if dvisvgm did not write one for that page.
+    """
+    pages = []
+    for match in _MEASURES_RE.finditer(output):
+        page, width, height, depth, svg_file = match.groups()
+        if page is not None:
+            pages.append([None, None, None, None])
+        elif not pages:
+            continue
+        elif width is not None and pages[-1][0] is None:
+            pages[-1][0] = float(width) / fontsize * scaling
+            pages[-1][1] = float(height) / fontsize * scaling
+        elif depth is not None and pages[-1][2] is None:
+            pages[-1][2] = float(depth) / fontsize * scaling
+        elif svg_file is not None:
+            pages[-1][3] = os.fsdecode(svg_file)
 
-def latex2svg(code, params=default_params, working_directory=None):
-    # Modify SVG attributes, to a get a self-contained, scaling SVG
-    from lxml import etree
+    # no baseline offset if depth not found
+    return [(width, height, 0.0 if depth is None else depth, svg_file) for width, height, depth, svg_file in pages]
+
+
+@functools.lru_cache(maxsize=32)
+def _document_parts(template, preamble, fontsize):
+    """Return the rendered template split at its `{code}` placeholders."""
+    if "mathenv" not in template:
+        raise ValueError("template must define the mathenv environment, see default_template")
+    # render with a sentinel as code, so escaped {{code}} and repeated {code} behave as in format_map
+    document = template.format_map(dict(preamble=preamble, fontsize=fontsize, code=_CODE_SENTINEL))
+    return tuple(document.split(_CODE_SENTINEL))
+
+
+@functools.lru_cache(maxsize=256)
+def _trivial_error(code):
+    """Return why LaTeX would obviously fail on `code`, or None if it may succeed."""
+    # verbatim text and escaped characters (\$, \{, ...) are content, not delimiters,
+    # and comments are ignored
+    code = _COMMENT_RE.sub("", _ESCAPED_RE.sub("_", _VERB_RE.sub("_", code)))
+    if not code.replace("$", "").strip():
+        return "Empty math!"
+    if code.count("$") % 2:
+        return "Unbalanced $ math delimiters"
+    depth = 0
+    for char in code:
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth < 0:
+                return "Unbalanced braces: extra }"
+    if depth:
+        return "Unbalanced braces: missing }"
+    return None
+
+
+def _cache_key(code, params):
+    """Return the cache key of a snippet rendered with the given parameters."""
+    fields = [_cache_version, code] + [str(params[name]) for name in _cache_params]
+    return hashlib.blake2b("\0".join(fields).encode("utf-8")).hexdigest()
+
+
+def _memoize(key, result):
+    """Keep a result in memory, evicting the least recently used one when full."""
+    with _memo_lock:
+        _memo.pop(key, None)
+        _memo[key] = result
+        if len(_memo) > _memo_size:
+            del _memo[next(iter(_memo))]
+
+
+def _cache_load(key, params):
+    """Return the cached result of a cache key, from memory or disk, or None on a cache miss."""
+    with _memo_lock:
+        result = _memo.get(key)
+    if result is None:
+        try:
+            with open(os.path.join(params["cache_dir"], key + ".json"), "r", encoding="utf-8") as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+    _memoize(key, result)
+    return result
+
+
+def _cache_store(key, params, result):
+    """Store a result in the cache, atomically so readers never see partial files."""
+    _memoize(key, result)
+    path = os.path.join(params["cache_dir"], key + ".json")
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        # caching is best effort, the result is still returned
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+class PreambleFormats:
+    """Preloaded LaTeX preambles shared by all the LaTeX runs of a session.
+
+    TeX cannot typeset several documents in a single process, so instead of
+    keeping LaTeX running, the preamble of each distinct document is dumped
+    once into a format file using the `mylatexformat` package. Later runs load
+    that format, which already contains the document class and packages, and
+    skip the preamble of their input. If a preamble cannot be dumped, or its
+    format makes a run fail where a normal run succeeds, LaTeX is run normally
+    for it from then on.
+
+    Format files live in a temporary directory removed at exit.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.formats = {}  # key -> format path, or None if it is not usable
+        self.lock = threading.Lock()
+
+    def run(self, latex_cmd, document, working_directory):
+        """Run LaTeX on `code.tex` in `working_directory`, with its preamble preloaded if possible."""
+        key, fmt = self.format(latex_cmd, document)
+        if fmt is not None:
+            try:
+                subprocess.run(latex_cmd + ["-fmt=" + fmt, "code.tex"], capture_output=True, check=True, cwd=working_directory)
+                return
+            except subprocess.CalledProcessError:
+                pass
+        subprocess.run(latex_cmd + ["code.tex"], capture_output=True, check=True, cwd=working_directory)
+        if fmt is not None:
+            # the code is fine, so the format is to blame: some packages can be
+            # dumped but misbehave when loaded from it
+            with self.lock:
+                self.formats[key] = None
+
+    def format(self, latex_cmd, document):
+        """Return the key and format file preloading the preamble of `document`, or None as file."""
+        end = document.find("\\begin{document}")
+        if end < 0:
+            return None, None
+        preamble = document[:end]
+        key = hashlib.blake2b("\0".join(latex_cmd + [preamble]).encode("utf-8")).hexdigest()[:16]
+        with self.lock:
+            if key not in self.formats:
+                self.formats[key] = self.dump(key, latex_cmd, preamble)
+            return key, self.formats[key]
+
+    def dump(self, key, latex_cmd, preamble):
+        if self.directory is None:
+            self.directory = mkdtemp(prefix="latex2svg-")
+            atexit.register(self.close)
+
+        Path(self.directory, key + ".tex").write_bytes((preamble + "\\begin{document}\n\\end{document}\n").encode("utf-8"))
+        # e.g. pdflatex -ini -jobname=<key> "&pdflatex" mylatexformat.ltx <key>.tex
+        engine = os.path.basename(latex_cmd[0])
+        try:
+            subprocess.run(
+                latex_cmd + ["-ini", "-jobname=" + key, "&" + engine, "mylatexformat.ltx", key + ".tex"],
+                capture_output=True,
+                check=True,
+                cwd=self.directory,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        fmt = os.path.join(self.directory, key)
+        return fmt if os.path.exists(fmt + ".fmt") else None
 
-    """Convert LaTeX to SVG using dvisvgm and scour (or svgo).
+    def close(self):
+        """Remove all format files."""
+        with self.lock:
+            if self.directory is not None:
+                shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self.formats = {}
+
+
+_preamble_formats = PreambleFormats()
+
+
+def latex2svg(code, params=default_params, working_directory=None):
+    """Convert LaTeX to SVG using dvisvgm.
 
     Parameters
     ----------
@@ -63,6 +340,7 @@ def latex2svg(code, params=default_params, working_directory=None):
         Conversion parameters.
     working_directory : str or None
         Working directory for external commands and place for temporary files.
+        When given, the cache is bypassed and the files are always produced.
 
     Returns
     -------
@@ -74,114 +352,248 @@ def latex2svg(code, params=default_params, working_directory=None):
         * `height`: image height in *em*
         * `valign`: baseline offset in *em*
     """
-    if working_directory is None:
-        with TemporaryDirectory() as tmpdir:
-            return latex2svg(code, params, working_directory=tmpdir)
+    return latex2svg_batch([code], params, working_directory)[0]
+
+
+def latex2svg_batch(codes, params=default_params, working_directory=None):
+    """Convert several LaTeX snippets to SVG with a single LaTeX and dvisvgm run.
 
-    # Caution: TeX & dvisvgm work with TeX pt (1/72.27"), but we need DTP pt (1/72")
-    # so we need a scaling factor for correct output sizes
-    # dvisvgm will produce a viewBox in DTP pt but SHOW TeX pt in its output.
-    scaling = 1.00375  # (1/72)/(1/72.27)
+    Every snippet is typeset on its own page of one `standalone` document, so
+    LaTeX and dvisvgm are only started once for the whole batch.
+
+    Parameters
+    ----------
+    codes : list of str
+        LaTeX snippets to render.
+    params : dict
+        Conversion parameters, shared by all snippets.
+    working_directory : str or None
+        Working directory for external commands and place for temporary files.
+        When given, the cache is bypassed and the files are always produced.
+
+    Returns
+    -------
+    list of dict
+        One dictionary per snippet, in order, as returned by `latex2svg`.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If LaTeX or dvisvgm fail. Obviously invalid snippets (empty math,
+        unbalanced `$` or braces) are rejected before LaTeX runs, with the
+        reason as `output` and a `cmd` naming the pre-check.
+    """
+    # parameters missing from older params dicts take their default value
+    params = {**default_params, **params}
+
+    # fail before starting LaTeX when the error is obvious
+    for code in codes:
+        error = _trivial_error(code)
+        if error is not None:
+            raise subprocess.CalledProcessError(1, "LaTeX pre-check (%s)" % error, output=error.encode("utf-8"), stderr=b"")
+
+    # the caller wants the files in working_directory, so always render there
+    if params["no_cache"] or working_directory is not None:
+        return _render_batch(codes, params, working_directory)
+
+    keys = [_cache_key(code, params) for code in codes]
+    results = [_cache_load(key, params) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        rendered = _render_batch([codes[i] for i in missing], params, working_directory)
+        for i, result in zip(missing, rendered):
+            _cache_store(keys[i], params, result)
+            results[i] = result
+    # callers get copies, the cached dicts are shared
+    return [dict(result) for result in results]
+
+
+def _render_batch(codes, params=default_params, working_directory=None):
+    """Run LaTeX, dvisvgm and scour on a batch of snippets, bypassing the cache."""
+    if working_directory is None:
+        with TemporaryDirectory(dir=params["tmp_dir"] or _tmp_root) as tmpdir:
+            return _render_batch(codes, params, working_directory=tmpdir)
 
     fontsize = params["fontsize"]
-    document = params["template"].replace("{{ preamble }}", params["preamble"]).replace("{{ fontsize }}", str(fontsize)).replace("{{ code }}", code)
+    body = "\n".join("\\begin{mathenv}\n%s\n\\end{mathenv}" % code for code in codes)
+    document = body.join(_document_parts(params["template"], params["preamble"], fontsize))
 
-    with open(os.path.join(working_directory, "code.tex"), "w") as f:
-        f.write(document)
-    # Run LaTeX and create DVI file
+    # explicit encoding and no newline translation, whatever the platform and locale
+    Path(working_directory, "code.tex").write_bytes(document.encode("utf-8"))
+    if params["engine"] == "pdflatex":
+        latex_cmd, dvisvgm_input = params["pdflatex_cmd"], ["--pdf", "code.pdf"]
+    else:
+        latex_cmd, dvisvgm_input = params["latex_cmd"], ["code.dvi"]
+
+    # Run LaTeX and create DVI (or PDF) file
     try:
-        ret = subprocess.run(
-            shlex.split(params["latex_cmd"] + " code.tex"),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=working_directory,
-        )
-        ret.check_returncode()
+        if params["preload_preamble"]:
+            _preamble_formats.run(latex_cmd, document, working_directory)
+        else:
+            subprocess.run(latex_cmd + ["code.tex"], capture_output=True, check=True, cwd=working_directory)
     except FileNotFoundError:
         raise RuntimeError("latex not found")
 
-    # Add LIBGS to environment if supplied
-    env = os.environ.copy()
+    # Add LIBGS to environment if supplied (dvisvgm --pdf only), else inherit it
+    env = {**os.environ, "LIBGS": params["libgs"]} if params["libgs"] else None
 
-    # Convert DVI to SVG
-    dvisvgm_cmd = params["dvisvgm_cmd"] + " --scale=%f" % params["scale"]
-    dvisvgm_cmd += " code.pdf"
+    # Convert DVI to SVG, one file per page (code-1.svg, code-2.svg, ...)
+    dvisvgm_cmd = params["dvisvgm_cmd"] + [f"--scale={params['scale']}", "--page=1-", "--output=code-%p.svg"] + dvisvgm_input
     try:
-        ret = subprocess.run(
-            shlex.split(dvisvgm_cmd),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=working_directory,
-            env=env,
-        )
-        ret.check_returncode()
+        ret = subprocess.run(dvisvgm_cmd, capture_output=True, check=True, cwd=working_directory, env=env)
     except FileNotFoundError:
         raise RuntimeError("dvisvgm not found")
 
-    # Parse dvisvgm output for size and alignment
-    def get_size(output):
-        regex = r"\b([0-9.]+)pt x ([0-9.]+)pt"
-        match = re.search(regex, output)
-        if match:
-            return (
-                float(match.group(1)) / fontsize * scaling,
-                float(match.group(2)) / fontsize * scaling,
-            )
+    measures = get_measures(ret.stderr, fontsize)
+
+    # files are taken from dvisvgm's output, not from the working directory
+    # which may hold pages of a previous, larger batch
+    svg_files = [svg_file for _, _, _, svg_file in measures if svg_file is not None]
+    if len(measures) != len(codes) or len(svg_files) != len(codes):
+        raise RuntimeError("dvisvgm produced %d pages for %d snippets" % (len(svg_files), len(codes)))
+
+    results = []
+    for width, height, depth, svg_file in measures:
+        svg = Path(working_directory, svg_file).read_bytes()
+        # Modify SVG attributes, to a get a self-contained, scaling SVG
+        if params["safe_mode"]:
+            svg = _set_svg_size_lxml(svg, width, height, depth)
         else:
-            return None, None
+            svg = _set_svg_size(svg, width, height, depth)
+        prefix = _random_prefix()
 
-    def get_measure(output, name):
-        regex = r"\b%s=([0-9.e-]+)pt" % name
-        match = re.search(regex, output)
-        if match:
-            return float(match.group(1)) / fontsize * scaling
+        if params["optimizer"] == "scour":
+            Path(working_directory, svg_file).write_bytes(svg)
+            svg = _scour(svg_file, prefix, params, working_directory, env)
         else:
-            return None
+            svg = _minify_svg(svg.decode("utf-8"), prefix)
+
+        results.append(
+            {
+                "svg": svg,
+                "valign": round(-depth, 6),
+                "width": round(width, 6),
+                "height": round(height, 6),
+            }
+        )
 
-    output = ret.stderr.decode("utf-8")
-    width, height = get_size(output)
-    depth = get_measure(output, "depth")
-    # no baseline offset if depth not found
-    if depth is None:
-        depth = 0.0
+    return results
 
-    # read SVG, discarding all comments ("<-- Generated by… -->")
-    parser = etree.XMLParser(remove_comments=True)
-    xml = etree.parse(os.path.join(working_directory, "code.svg"), parser)
-    svg = xml.getroot()
-    svg.set("width", f"{width:.6f}em")
-    svg.set("height", f"{height:.6f}em")
-    svg.set("style", f"vertical-align:{-depth:.6f}em")
-    xml.write(os.path.join(working_directory, "code.svg"))
-
-    prefix = "".join(random.choice(string.ascii_letters) for n in range(3))
+
+def _scour(svg_file, prefix, params, working_directory, env):
+    """Optimize an SVG file using scour and return the optimized SVG."""
     # with scour, input & output files must be different
-    scour_cmd = params["scour_cmd"].replace("{{ prefix }}", prefix + "_").replace("{{ infile }}", "code.svg").replace("{{ outfile }}", "optimized.svg")
+    optimized_file = "optimized-" + svg_file
+    scour_cmd = [arg.replace("{{ prefix }}", prefix + "_").replace("{{ infile }}", svg_file).replace("{{ outfile }}", optimized_file) for arg in params["scour_cmd"]]
 
-    # optimize SVG using scour (default)
     try:
-        ret = subprocess.run(
-            shlex.split(scour_cmd),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=working_directory,
-            env=env,
-        )
-        ret.check_returncode()
+        subprocess.run(scour_cmd, capture_output=True, check=True, cwd=working_directory, env=env)
     except FileNotFoundError:
         print("scour not found, using unoptimized SVG", file=sys.stderr)
-        with open(os.path.join(working_directory, "code.svg"), "r") as f:
-            svg = f.read()
+        optimized_file = svg_file
+
+    return Path(working_directory, optimized_file).read_text(encoding="utf-8")
+
+
+def _random_prefix():
+    """Return a random 3-letter prefix, keeping ids unique when SVGs are pasted together."""
+    prefix = ""
+    # base32 also has digits, which are not allowed at the start of an id
+    while not prefix.isalpha():
+        prefix = base64.b32encode(os.urandom(3))[:3].decode("ascii").lower()
+    return prefix
 
-    with open(os.path.join(working_directory, "optimized.svg"), "r") as f:
-        svg = f.read()
 
-    return {
-        "svg": svg,
-        "valign": round(-depth, 6),
-        "width": round(width, 6),
-        "height": round(height, 6),
-    }
+def _set_svg_size(svg, width, height, depth):
+    """Set the size and baseline offset (in em) of an SVG by editing its opening tag."""
+
+    def patch(match):
+        # keep viewBox and namespaces, replace any existing size or style
+        attributes = _SIZE_ATTR_RE.sub(b"", match.group(0)[len(b"<svg") :])
+        return b'<svg width="%.6fem" height="%.6fem" style="vertical-align:%.6fem"' % (width, height, -depth) + attributes
+
+    return _SVG_OPEN_RE.sub(patch, svg, count=1)
+
+
+def _set_svg_size_lxml(svg, width, height, depth):
+    """Same as `_set_svg_size`, going through a full XML parse (`params["safe_mode"]`)."""
+    from lxml import etree
+
+    # read SVG, discarding all comments ("<-- Generated by… -->")
+    parser = etree.XMLParser(remove_comments=True)
+    root = etree.fromstring(svg, parser)
+    root.set("width", f"{width:.6f}em")
+    root.set("height", f"{height:.6f}em")
+    root.set("style", f"vertical-align:{-depth:.6f}em")
+    return etree.tostring(root)
+
+
+def _minify_svg(svg, prefix):
+    """Optimize SVG markup like scour does.
+
+    The XML prolog, comments and metadata are dropped, ids are shortened to
+    `<prefix>_<n>` and references to them are updated, and whitespace between
+    tags is removed.
+    """
+    svg = _STRIP_RE.sub("", svg)
+
+    ids = {}
+    for old_id in _ID_RE.findall(svg):
+        ids.setdefault(old_id, "%s_%d" % (prefix, len(ids)))
+
+    # id="…" definitions, url(#…) in styles and clip paths, #… in (xlink:)href
+    def rename(match):
+        return match.group(1) + ids.get(match.group(2), match.group(2))
+
+    svg = _ID_REF_RE.sub(rename, svg)
+    return _BETWEEN_TAGS_RE.sub("><", svg).strip()
+
+
+def latex2svg_many(codes, params=default_params, max_workers=None):
+    """Convert LaTeX snippets to SVG with one `latex2svg` call per snippet, in parallel.
+
+    Use this instead of `latex2svg_batch` when snippets cannot share a single
+    document. Cached snippets are returned directly, the others are rendered
+    each in its own process and temporary directory, so `params` must be
+    picklable.
+
+    Parameters
+    ----------
+    codes : list of str
+        LaTeX snippets to render.
+    params : dict
+        Conversion parameters, shared by all snippets.
+    max_workers : int or None
+        Number of worker processes (default: number of CPUs).
+
+    Returns
+    -------
+    list of dict
+        One dictionary per snippet, in order, as returned by `latex2svg`.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    # parameters missing from older params dicts take their default value
+    params = {**default_params, **params}
+
+    # look the cache up here, only misses are sent to the workers
+    if params["no_cache"]:
+        keys, results = [None] * len(codes), [None] * len(codes)
+    else:
+        keys = [_cache_key(code, params) for code in codes]
+        results = [_cache_load(key, params) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        # a worker renders few snippets, dumping their preamble would not pay off
+        worker_params = {**params, "preload_preamble": False}
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            rendered = executor.map(latex2svg, [codes[i] for i in missing], [worker_params] * len(missing))
+            for i, result in zip(missing, rendered):
+                # workers already stored it on disk, keep it in this process too
+                if keys[i] is not None:
+                    _memoize(keys[i], result)
+                results[i] = result
+    return [dict(result) for result in results]
 
 
 def ui():
@@ -206,6 +618,8 @@ def ui():
             # Changing the font size in the latex preamble does not impact math size
             # so we need to scale the output SVG instead
             params["scale"] = font_size / 10
+            # the UI keeps running, so loading the preamble once pays off from the second conversion
+            params["preload_preamble"] = True
 
             convert_button.config(text="Converting...", bg="orange")
             root.update()
@@ -220,10 +634,9 @@ def ui():
             convert_button.config(text="Copy", bg="grey")
             root.update()
 
+            # empty or unbalanced math is reported by latex2svg before running LaTeX
             if type(exc) == subprocess.CalledProcessError:
                 e = exc.output.decode("utf-8") + exc.stderr.decode("utf-8")
-            elif latex_code == EMPTY_MATH:
-                e = "Empty math!"
             else:
                 e = str(exc)
 
@@ -319,13 +732,12 @@ $$"""
 
 
 def cli():
-    import pyperclip
-
     """Simple command line interface to latex2svg."""
+    import argparse
 
     parser = argparse.ArgumentParser(
         description="""
-    This script converts LaTeX code to SVG using LaTeX, dvisvgm and scour. The resulting SVG is copied to the clipboard.
+    This script converts LaTeX code to SVG using LaTeX and dvisvgm. The resulting SVG is copied to the clipboard.
     """
     )
     parser.add_argument(
@@ -349,6 +761,8 @@ def cli():
 
         out = latex2svg(latex, params)
 
+        import pyperclip
+
         pyperclip.copy(out["svg"])
         print("SVG copied to clipboard")
 
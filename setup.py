@@ -9,7 +9,7 @@ with open("README.md", "r", encoding="utf-8") as f:
 setup(
     name='latex2svg',
     version=VERSION,
-    description='Converts LaTeX math code to SVG using pdflatex, dvisvgm, and scour',
+    description='Converts LaTeX math code to SVG using LaTeX and dvisvgm',
     long_description_content_type="text/markdown",
     long_description=long_description,
     classifiers=[
@@ -35,12 +35,14 @@ setup(
     entry_points={
         'console_scripts': ['latex2svg=latex2svg:main'],
     },
-    python_requires='>=3',
+    python_requires='>=3.7',
     install_requires=[
-        'lxml',
-        'scour',
         'pyperclip'
     ],
+    extras_require={
+        'scour': ['scour'],
+        'safe': ['lxml'],
+    },
     include_package_data=True,
     zip_safe=False,
 )